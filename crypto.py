@@ -2,14 +2,16 @@ import os
 import sys
 import sqlite3
 import re
+import time
+import bisect
 import asyncio
-from typing import Optional, Tuple, List
+from typing import Optional, Tuple, List, Dict
 
 import aiohttp
 from dotenv import load_dotenv
 from loguru import logger
 from pyrogram import Client, filters, idle
-from pyrogram.errors import FloodWait, MessageNotModified
+from pyrogram.errors import FloodWait, MessageNotModified, RPCError, InternalServerError
 from pyrogram.types import MessageEntity
 from pyrogram.enums import MessageEntityType
 from pyrogram.handlers import MessageHandler
@@ -41,6 +43,9 @@ API_HASH = os.getenv("API_HASH", "")
 PHONE_NUMBER = os.getenv("PHONE_NUMBER", "")
 SESSION_NAME = os.getenv("SESSION_NAME", "account")
 
+ALERTS_DB_PATH = os.getenv("ALERTS_DB_PATH", "alerts.db")
+ALERTS_POLL_SEC = int(os.getenv("ALERTS_POLL_SEC", "15"))
+
 
 """ --- UTF16 HELPERS --- """
 
@@ -66,13 +71,13 @@ CUSTOM_EMOJI_MAP: dict[str, int] = {
 
 """ --- HTTP: BINANCE PRICE --- """
 
-async def fetch_ton_price_usdt() -> Optional[float]:
+async def fetch_price_usdt(symbol: str) -> Optional[float]:
     timeout = aiohttp.ClientTimeout(total=10)
     async with aiohttp.ClientSession(timeout=timeout) as session:
         try:
             async with session.get(
                 "https://api.binance.com/api/v3/ticker/price",
-                params={"symbol": BINANCE_TON_SYMBOL},
+                params={"symbol": symbol},
             ) as resp:
                 if resp.status != 200:
                     return None
@@ -85,23 +90,12 @@ async def fetch_ton_price_usdt() -> Optional[float]:
             return None
 
 
+async def fetch_ton_price_usdt() -> Optional[float]:
+    return await fetch_price_usdt(BINANCE_TON_SYMBOL)
+
+
 async def fetch_sol_price_usdt() -> Optional[float]:
-    timeout = aiohttp.ClientTimeout(total=10)
-    async with aiohttp.ClientSession(timeout=timeout) as session:
-        try:
-            async with session.get(
-                "https://api.binance.com/api/v3/ticker/price",
-                params={"symbol": BINANCE_SOL_SYMBOL},
-            ) as resp:
-                if resp.status != 200:
-                    return None
-                data = await resp.json()
-                price_str = data.get("price")
-                if price_str is None:
-                    return None
-                return float(price_str)
-        except Exception:
-            return None
+    return await fetch_price_usdt(BINANCE_SOL_SYMBOL)
 
 
 """ --- TEXT/ENTITY BUILDERS --- """
@@ -193,6 +187,18 @@ def format_error() -> Tuple[str, List[MessageEntity]]:
 
 _cmd_re = re.compile(r"^\.(ton|usdt)(?:\s+(\S+))?", re.IGNORECASE)
 _sol_re = re.compile(r"^\.sol(?:\s+(\S+))?", re.IGNORECASE)
+_alert_re = re.compile(r"^\.alert(?:\s+(.*))?$", re.IGNORECASE | re.DOTALL)
+_alert_args_re = re.compile(r"^([a-z0-9]+)\s*([<>])\s*(\S+)$", re.IGNORECASE)
+
+
+def parse_threshold(token: str) -> Optional[float]:
+    cleaned = token.strip().replace(",", ".")
+    if not re.fullmatch(r"\d+(?:\.\d+)?", cleaned):
+        return None
+    try:
+        return float(cleaned)
+    except Exception:
+        return None
 
 
 def parse_amount(token: str) -> Optional[float]:
@@ -220,10 +226,221 @@ async def safe_edit(message, text: str, entities: Optional[List[MessageEntity]]
             return
 
 
+""" --- PRICE ALERTS --- """
+
+class PriceAlertIndex:
+    def __init__(self, db_path: str) -> None:
+        self._db = sqlite3.connect(db_path)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS alerts ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "chat_id INTEGER NOT NULL, "
+            "symbol TEXT NOT NULL, "
+            "op TEXT NOT NULL, "
+            "threshold REAL NOT NULL, "
+            "created_at INTEGER NOT NULL)"
+        )
+        self._db.commit()
+        self._above: Dict[str, List[Tuple[float, int]]] = {}
+        self._below: Dict[str, List[Tuple[float, int]]] = {}
+        self._chats: Dict[int, int] = {}
+        for alert_id, chat_id, symbol, op, threshold in self._db.execute(
+            "SELECT id, chat_id, symbol, op, threshold FROM alerts"
+        ):
+            self._insert(alert_id, chat_id, symbol, op, threshold)
+        logger.info(f"price-alerts-loaded count={len(self._chats)}")
+
+    def _insert(self, alert_id: int, chat_id: int, symbol: str, op: str, threshold: float) -> None:
+        index = self._above if op == ">" else self._below
+        bisect.insort(index.setdefault(symbol, []), (threshold, alert_id))
+        self._chats[alert_id] = chat_id
+
+    def add(self, chat_id: int, symbol: str, op: str, threshold: float) -> int:
+        cur = self._db.execute(
+            "INSERT INTO alerts (chat_id, symbol, op, threshold, created_at) VALUES (?, ?, ?, ?, ?)",
+            (chat_id, symbol, op, threshold, int(time.time())),
+        )
+        self._db.commit()
+        alert_id = cur.lastrowid
+        self._insert(alert_id, chat_id, symbol, op, threshold)
+        return alert_id
+
+    def symbols(self) -> List[str]:
+        return sorted({s for s, v in self._above.items() if v} | {s for s, v in self._below.items() if v})
+
+    def on_price(self, symbol: str, price: float) -> List[Tuple[int, int, str, float]]:
+        fired: List[Tuple[int, int, str, float]] = []
+
+        above = self._above.get(symbol)
+        if above:
+            cut = bisect.bisect_left(above, (price, -1))
+            fired.extend((alert_id, self._chats.pop(alert_id), ">", threshold) for threshold, alert_id in above[:cut])
+            del above[:cut]
+
+        below = self._below.get(symbol)
+        if below:
+            cut = bisect.bisect_right(below, (price, float("inf")))
+            fired.extend((alert_id, self._chats.pop(alert_id), "<", threshold) for threshold, alert_id in below[cut:])
+            del below[cut:]
+
+        return fired
+
+    def confirm(self, alert_id: int) -> None:
+        self._db.execute("DELETE FROM alerts WHERE id = ?", (alert_id,))
+        self._db.commit()
+
+    def restore(self, alert_id: int, chat_id: int, symbol: str, op: str, threshold: float) -> None:
+        self._insert(alert_id, chat_id, symbol, op, threshold)
+
+
+_alert_index: Optional[PriceAlertIndex] = None
+
+
+def get_alert_index() -> PriceAlertIndex:
+    global _alert_index
+    if _alert_index is None:
+        _alert_index = PriceAlertIndex(ALERTS_DB_PATH)
+    return _alert_index
+
+
+def _symbol_emoji(symbol: str) -> str:
+    if symbol == BINANCE_TON_SYMBOL:
+        return "💎"
+    if symbol == BINANCE_SOL_SYMBOL:
+        return "🪙"
+    return "✨"
+
+
+def _format_price(value: float) -> str:
+    return f"{value:.8f}".rstrip("0").rstrip(".")
+
+
+def format_alert_created(symbol: str, op: str, threshold: float) -> Tuple[str, List[MessageEntity]]:
+    name = symbol.replace("USDT", "")
+    text = f"{_symbol_emoji(symbol)} Алерт {name} {op} {_format_price(threshold)} 💵 создан\n\n ✨ by @Th3ryks"
+    entities = build_entities_for_text(text)
+    return text, entities
+
+
+def format_alert_fired(symbol: str, op: str, threshold: float, price: float) -> Tuple[str, List[MessageEntity]]:
+    name = symbol.replace("USDT", "")
+    text = (
+        f"{_symbol_emoji(symbol)} {name} {op} {_format_price(threshold)} 💵\n\n"
+        f" • 💵: {_format_price(price)}\n\n"
+        f" ✨ by @Th3ryks"
+    )
+    entities = build_entities_for_text(text)
+    return text, entities
+
+
+def format_alert_unknown_symbol(symbol: str) -> Tuple[str, List[MessageEntity]]:
+    text = f"✨ не удалось получить цену {symbol} на Binance\n\n ✨ by @Th3ryks"
+    entities = build_entities_for_text(text)
+    return text, entities
+
+
+def format_alert_already_crossed(symbol: str, op: str, threshold: float, price: float) -> Tuple[str, List[MessageEntity]]:
+    name = symbol.replace("USDT", "")
+    text = (
+        f"{_symbol_emoji(symbol)} {name} уже {op} {_format_price(threshold)} 💵\n\n"
+        f" • 💵: {_format_price(price)}\n\n"
+        f" ✨ by @Th3ryks"
+    )
+    entities = build_entities_for_text(text)
+    return text, entities
+
+
+def format_alert_usage() -> Tuple[str, List[MessageEntity]]:
+    text = "✨ формат: .alert ton > 6.5\n\n ✨ by @Th3ryks"
+    entities = build_entities_for_text(text)
+    return text, entities
+
+
+async def _alert_tick(app: Client, index: PriceAlertIndex) -> None:
+    symbols = index.symbols()
+    if not symbols:
+        return
+    prices = await asyncio.gather(*(fetch_price_usdt(s) for s in symbols))
+    for symbol, price in zip(symbols, prices):
+        if price is None:
+            continue
+        for alert_id, chat_id, op, threshold in index.on_price(symbol, price):
+            text_out, entities_out = format_alert_fired(symbol, op, threshold, price)
+            try:
+                try:
+                    await app.send_message(chat_id, text_out, entities=entities_out)
+                except FloodWait as e:
+                    await asyncio.sleep(e.value)
+                    await app.send_message(chat_id, text_out, entities=entities_out)
+            except (FloodWait, InternalServerError, OSError, asyncio.TimeoutError) as e:
+                index.restore(alert_id, chat_id, symbol, op, threshold)
+                logger.info(f"price-alert-send-retry id={alert_id} chat_id={chat_id}: {e}")
+                continue
+            except Exception as e:
+                index.confirm(alert_id)
+                kind = "rpc" if isinstance(e, RPCError) else "unexpected"
+                logger.info(f"price-alert-dropped id={alert_id} chat_id={chat_id} error={kind}: {e}")
+                continue
+            index.confirm(alert_id)
+            logger.info(f"price-alert-fired id={alert_id} symbol={symbol} op={op} threshold={threshold} price={price}")
+
+
+async def run_price_alerts(app: Client) -> None:
+    index = get_alert_index()
+    logger.info(f"price-alerts-started poll={ALERTS_POLL_SEC}s")
+    while True:
+        try:
+            await _alert_tick(app, index)
+        except Exception as e:
+            logger.info(f"price-alerts-tick-error: {e}")
+        await asyncio.sleep(ALERTS_POLL_SEC)
+
+
+def start_price_alerts(app: Client) -> asyncio.Task:
+    return asyncio.create_task(run_price_alerts(app))
+
+
 """ --- HANDLERS --- """
 
+async def handle_alert_message(message, malert: re.Match) -> None:
+    margs = _alert_args_re.match((malert.group(1) or "").strip())
+    if not margs:
+        usage_text, usage_entities = format_alert_usage()
+        await safe_edit(message, usage_text, usage_entities)
+        return
+
+    threshold = parse_threshold(margs.group(3))
+    if threshold is None:
+        err_text, err_entities = format_error()
+        await safe_edit(message, err_text, err_entities)
+        return
+
+    symbol = margs.group(1).upper() + "USDT"
+    price = await fetch_price_usdt(symbol)
+    if price is None:
+        err_text, err_entities = format_alert_unknown_symbol(margs.group(1).upper())
+        await safe_edit(message, err_text, err_entities)
+        return
+
+    op = margs.group(2)
+    if (op == ">" and price > threshold) or (op == "<" and price < threshold):
+        out_text, out_entities = format_alert_already_crossed(symbol, op, threshold, price)
+        await safe_edit(message, out_text, out_entities)
+        return
+
+    alert_id = get_alert_index().add(message.chat.id, symbol, op, threshold)
+    logger.info(f"price-alert-created id={alert_id} symbol={symbol} op={op} threshold={threshold}")
+    out_text, out_entities = format_alert_created(symbol, op, threshold)
+    await safe_edit(message, out_text, out_entities)
+
+
 async def handle_crypto_message(_, message) -> None:
     text = message.text or ""
+    malert = _alert_re.match(text)
+    if malert:
+        await handle_alert_message(message, malert)
+        return
+
     msol = _sol_re.match(text)
     if msol:
         token = msol.group(1)
@@ -318,7 +535,9 @@ async def main() -> None:
         logger.info("pyrogram session locked persistently; aborting start")
         return
     logger.info("pyrogram client started (crypto)")
+    alerts_task = start_price_alerts(app)
     await idle()
+    alerts_task.cancel()
 
 
 if __name__ == "__main__":
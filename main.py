@@ -1,8 +1,12 @@
 import os
+import re
+import math
 import sys
+import json
 import asyncio
 import sqlite3
 import aiohttp
+from contextlib import aclosing
 from dotenv import load_dotenv
 from loguru import logger
 from pyrogram import Client, filters
@@ -12,7 +16,7 @@ from pyrogram.handlers import MessageHandler
 from openai import AsyncOpenAI
 from pyrogram.types import MessageEntity
 from pyrogram.enums import MessageEntityType
-from crypto import attach_crypto_handlers
+from crypto import attach_crypto_handlers, start_price_alerts
 
 logger.remove()
 logger.add(
@@ -40,12 +44,22 @@ OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
 LLM_BASE_URL = os.getenv("LLM_BASE_URL", "https://openrouter.ai/api/v1")
 LLM_MODEL = os.getenv("LLM_MODEL", "qwen/qwen3-coder-plus")
 LLM_MAX_TOKENS = int(os.getenv("LLM_MAX_TOKENS", "2048"))
+LLM_STREAM_BACKEND = os.getenv("LLM_STREAM_BACKEND", "sdk").lower()
+LLM_MIN_TOKENS = 64
+LLM_CHARS_PER_TOKEN = float(os.getenv("LLM_CHARS_PER_TOKEN", "1.0"))
+LLM_FANOUT_ENABLED = os.getenv("LLM_FANOUT", "1") == "1"
+LLM_FANOUT_CONCURRENCY = int(os.getenv("LLM_FANOUT_CONCURRENCY", "4"))
+LLM_FANOUT_MAX_PARTS = 8
+LLM_FANOUT_MIN_SECTION_CHARS = 200
+LLM_FANOUT_SECTION_RESERVE_CHARS = 40
 
 ai_client = AsyncOpenAI(
     base_url=LLM_BASE_URL,
     api_key=OPENROUTER_API_KEY,
 )
-logger.info(f"llm-client-ready base_url={LLM_BASE_URL} model={LLM_MODEL} max_tokens={LLM_MAX_TOKENS}")
+logger.info(
+    f"llm-client-ready base_url={LLM_BASE_URL} model={LLM_MODEL} max_tokens={LLM_MAX_TOKENS} backend={LLM_STREAM_BACKEND}"
+)
 
 def _utf16_len(s: str) -> int:
     return len(s.encode("utf-16-le")) // 2
@@ -266,6 +280,149 @@ async def maybe_answer_crypto(message, query: str) -> bool:
     text = "❓ Запрос: " + query + "\n\n" + "💡 Ответ:\n" + body
     await safe_edit(message, text)
     return True
+
+
+def estimate_tokens(chars: int) -> int:
+    return math.ceil(chars / max(LLM_CHARS_PER_TOKEN, 0.1))
+
+
+def output_token_budget(header_len: int) -> int:
+    remaining = 4096 - header_len
+    if remaining <= 0:
+        return LLM_MIN_TOKENS
+    return max(LLM_MIN_TOKENS, min(LLM_MAX_TOKENS, estimate_tokens(remaining)))
+
+
+class LLMStreamError(Exception):
+    pass
+
+
+async def _iter_sdk_deltas(system_instruction, prompt, max_tokens):
+    stream = await ai_client.chat.completions.create(
+        model=LLM_MODEL,
+        messages=[
+            {"role": "system", "content": system_instruction},
+            {"role": "user", "content": prompt},
+        ],
+        stream=True,
+        max_tokens=max_tokens,
+    )
+    logger.info("llm-stream-started backend=sdk")
+    try:
+        async for chunk in stream:
+            try:
+                delta = chunk.choices[0].delta
+            except Exception as e:
+                logger.info(f"stream-chunk-error: {e}")
+                break
+            if delta and delta.content:
+                yield delta.content
+    finally:
+        try:
+            await stream.close()
+        except Exception as e:
+            logger.info(f"stream-close-error: {e}")
+
+
+_sse_session: aiohttp.ClientSession | None = None
+
+
+def _get_sse_session() -> aiohttp.ClientSession:
+    global _sse_session
+    if _sse_session is None or _sse_session.closed:
+        _sse_session = aiohttp.ClientSession()
+    return _sse_session
+
+
+async def close_sse_session() -> None:
+    if _sse_session is not None and not _sse_session.closed:
+        await _sse_session.close()
+
+
+async def _iter_sse_deltas(system_instruction, prompt, max_tokens):
+    payload = {
+        "model": LLM_MODEL,
+        "messages": [
+            {"role": "system", "content": system_instruction},
+            {"role": "user", "content": prompt},
+        ],
+        "stream": True,
+        "max_tokens": max_tokens,
+    }
+    headers = {
+        "Authorization": f"Bearer {OPENROUTER_API_KEY}",
+        "Accept": "text/event-stream",
+    }
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=60)
+    session = _get_sse_session()
+    async with session.post(
+        LLM_BASE_URL.rstrip("/") + "/chat/completions", json=payload, headers=headers, timeout=timeout
+    ) as resp:
+        if resp.status != 200:
+            raise aiohttp.ClientResponseError(
+                resp.request_info, resp.history, status=resp.status, message=await resp.text()
+            )
+        logger.info("llm-stream-started backend=sse")
+        finish_reason = None
+        async for line in resp.content:
+            if not line.startswith(b"data:"):
+                continue
+            data = line[5:].strip()
+            if data == b"[DONE]":
+                break
+            try:
+                event = json.loads(data)
+            except ValueError:
+                logger.info(f"llm-sse-bad-payload: {data[:200]!r}")
+                continue
+            if not isinstance(event, dict):
+                logger.info(f"llm-sse-bad-payload: {data[:200]!r}")
+                continue
+            if event.get("error"):
+                raise LLMStreamError(f"provider error: {event['error']}")
+            choices = event.get("choices")
+            if not choices:
+                continue
+            choice = choices[0]
+            content = (choice.get("delta") or {}).get("content")
+            if content:
+                yield content
+            if choice.get("finish_reason"):
+                finish_reason = choice["finish_reason"]
+        logger.info(f"llm-stream-finish reason={finish_reason}")
+
+
+async def _iter_deltas(system_instruction, prompt, max_tokens):
+    if LLM_STREAM_BACKEND == "sse":
+        started = False
+        try:
+            async with aclosing(_iter_sse_deltas(system_instruction, prompt, max_tokens)) as deltas:
+                async for content in deltas:
+                    started = True
+                    yield content
+            return
+        except (aiohttp.ClientError, asyncio.TimeoutError, LLMStreamError) as e:
+            if started:
+                raise
+            logger.info(f"llm-sse-fallback: {e}")
+    async with aclosing(_iter_sdk_deltas(system_instruction, prompt, max_tokens)) as deltas:
+        async for content in deltas:
+            yield content
+
+
+async def stream_completion(system_instruction, prompt, max_tokens, answer_parts, output_full):
+    received_chars = 0
+    async with aclosing(_iter_deltas(system_instruction, prompt, max_tokens)) as deltas:
+        async for content in deltas:
+            answer_parts.append(content)
+            received_chars += len(content)
+            if len(answer_parts) % 50 == 0:
+                logger.info(f"llm-chunks-collected={len(answer_parts)}")
+            if output_full(received_chars):
+                logger.info(f"llm-stream-output-full chars={received_chars}")
+                break
+
+
 async def stream_and_edit(message, prompt):
     system_instruction = (
         "Respond only in Russian. "
@@ -320,31 +477,21 @@ async def stream_and_edit(message, prompt):
             structured_text = build_structured_text(prompt, theme_holder["theme"], body)
             await safe_edit(message, structured_text)
 
+    def output_full(received_chars: int) -> bool:
+        if received_chars + header_len < 4096:
+            return False
+        theme, body = parse_theme_and_body("".join(answer_parts))
+        return len(build_structured_text(prompt, theme, body)) >= 4096
+
+    header_len = len(build_structured_text(prompt, None, ""))
+    max_tokens = output_token_budget(header_len)
+    logger.info(f"llm-token-budget header_len={header_len} max_tokens={max_tokens}")
+
     editor_task = asyncio.create_task(editor_loop())
     logger.info("stream-editor-started")
 
     try:
-        stream = await ai_client.chat.completions.create(
-            model=LLM_MODEL,
-            messages=[
-                {"role": "system", "content": system_instruction},
-                {"role": "user", "content": prompt},
-            ],
-            stream=True,
-            max_tokens=LLM_MAX_TOKENS,
-        )
-        logger.info("llm-stream-started")
-
-        async for chunk in stream:
-            try:
-                delta = chunk.choices[0].delta
-                if delta and delta.content:
-                    answer_parts.append(delta.content)
-                    if len(answer_parts) % 50 == 0:
-                        logger.info(f"llm-chunks-collected={len(answer_parts)}")
-            except Exception as e:
-                logger.info(f"stream-chunk-error: {e}")
-                break
+        await stream_completion(system_instruction, prompt, max_tokens, answer_parts, output_full)
     finally:
         stop_event.set()
         await editor_task
@@ -362,6 +509,108 @@ async def stream_and_edit(message, prompt):
         logger.info("llm-stream-finished")
 
 
+_fanout_item_re = re.compile(r"^\s*(?:\d+[.)]|[-•])\s+(.*\S)\s*$")
+
+
+def split_sub_queries(query: str) -> list[str] | None:
+    lines = [line.strip() for line in query.splitlines() if line.strip()]
+    if len(lines) < 2 or len(lines) > LLM_FANOUT_MAX_PARTS:
+        return None
+    items = [_fanout_item_re.match(line) for line in lines]
+    if all(items):
+        return [m.group(1) for m in items]
+    if all(line.endswith("?") for line in lines):
+        return lines
+    return None
+
+
+def truncate_section(body: str, limit: int) -> str:
+    if len(body) <= limit:
+        return body
+    cut = body.rfind("\n", 0, limit)
+    text = body[:cut] if cut > 0 else body[:limit]
+    if text.count("```") % 2:
+        text += "\n```"
+    elif text.count("**") % 2:
+        text += "**"
+    return text.rstrip() + "\n…"
+
+
+async def fanout_stream_and_edit(message, prompt, sub_queries: list[str]) -> bool:
+    system_instruction = (
+        "Respond only in Russian. "
+        "The user message contains several related questions followed by the number of the one to answer. "
+        "Use the other questions only as context and answer only the indicated question, directly and concisely, without repeating it. "
+        "If the request is about code/scripts/programs/apps, provide fully working code first, then a brief explanation. "
+        "Use lists with • or - and separate paragraphs with one blank line. "
+        "Avoid greetings and meta-comments."
+    )
+
+    header = "❓ Запрос: " + prompt + "\n\n" + "💡 Ответ:\n"
+    titles = [f"**{i}.** " for i in range(1, len(sub_queries) + 1)]
+    separators_len = 2 * (len(sub_queries) - 1)
+    share = (4096 - len(header) - sum(len(t) for t in titles) - separators_len) // len(sub_queries)
+    if share < LLM_FANOUT_MIN_SECTION_CHARS:
+        logger.info(f"fanout-skipped section_chars={share}")
+        return False
+
+    max_tokens = max(LLM_MIN_TOKENS, min(LLM_MAX_TOKENS, estimate_tokens(share)))
+    sections: list[list[str]] = [[] for _ in sub_queries]
+    done = [False] * len(sub_queries)
+    errors: list[str | None] = [None] * len(sub_queries)
+    stop_event = asyncio.Event()
+    semaphore = asyncio.Semaphore(LLM_FANOUT_CONCURRENCY)
+
+    def build_fanout_text() -> str:
+        rendered = []
+        for title, parts, finished, error in zip(titles, sections, done, errors):
+            body = truncate_section("".join(parts).strip(), share - LLM_FANOUT_SECTION_RESERVE_CHARS)
+            if error:
+                body = (body + "\n\n" if body else "") + "⚠️ Не удалось получить ответ"
+            elif not body and not finished:
+                body = "⏳"
+            rendered.append(title + body)
+        return header + "\n\n".join(rendered)
+
+    async def run_section(idx: int, sub_query: str):
+        parts = sections[idx]
+        async with semaphore:
+            try:
+                await stream_completion(
+                    system_instruction,
+                    f"{prompt}\n\nОтветь только на вопрос {idx + 1}: {sub_query}",
+                    max_tokens,
+                    parts,
+                    lambda received_chars: received_chars >= share,
+                )
+            except Exception as e:
+                errors[idx] = str(e) or type(e).__name__
+                logger.info(f"fanout-section-error idx={idx}: {e}")
+            finally:
+                done[idx] = True
+                logger.info(f"fanout-section-finished idx={idx} chars={sum(len(p) for p in parts)}")
+
+    async def editor_loop():
+        while not stop_event.is_set():
+            await asyncio.sleep(3)
+            await safe_edit(message, build_fanout_text())
+
+    editor_task = asyncio.create_task(editor_loop())
+    logger.info(f"fanout-started parts={len(sub_queries)} concurrency={LLM_FANOUT_CONCURRENCY} max_tokens={max_tokens}")
+
+    try:
+        await asyncio.gather(*(run_section(i, q) for i, q in enumerate(sub_queries)))
+    finally:
+        stop_event.set()
+        await editor_task
+    if all(errors):
+        logger.info("fanout-failed all sections errored; falling back to single stream")
+        return False
+    await safe_edit(message, build_fanout_text())
+    logger.info(f"fanout-finished failed={sum(1 for e in errors if e)}")
+    return True
+
+
 async def handle_message(_, message):
     text = message.text or ""
     if text.startswith(".ai"):
@@ -381,6 +630,10 @@ async def handle_message(_, message):
         logger.info(
             f"request-started chat_id={message.chat.id} message_id={message.id} query_len={len(query)}"
         )
+        sub_queries = split_sub_queries(query) if LLM_FANOUT_ENABLED else None
+        if sub_queries and await fanout_stream_and_edit(message, query, sub_queries):
+            logger.info("request-finished")
+            return
         if await maybe_answer_crypto(message, query):
             logger.info("crypto-answer-sent")
             return
@@ -417,7 +670,10 @@ async def main():
         logger.info("pyrogram session locked persistently; aborting start")
         return
     logger.info("pyrogram client started")
+    alerts_task = start_price_alerts(app)
     await idle()
+    alerts_task.cancel()
+    await close_sse_session()
 
 
 if __name__ == "__main__":